@@ -1,12 +1,15 @@
 import asyncio
 import time
+import threading
 import httpx
-import json
+import logging
+import re
+import orjson
 from collections import defaultdict
 from functools import wraps
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from cachetools import TTLCache
+from cachetools import LRUCache, TTLCache
 from typing import Tuple
 from proto import FreeFire_pb2, main_pb2, AccountPersonalShow_pb2
 from google.protobuf import json_format, message
@@ -21,14 +24,49 @@ MAIN_IV = base64.b64decode('Nm95WkRyMjJFM3ljaGpNJQ==')
 RELEASEVERSION = "OB52"
 USERAGENT = "Dalvik/2.1.0 (Linux; U; Android 13; CPH2095 Build/RKQ1.211119.001)"
 SUPPORTED_REGIONS = {"IND", "BR", "US", "SAC", "NA", "SG", "RU", "ID", "TW", "VN", "TH", "ME", "PK", "CIS", "BD", "EUROPE"}
+HTTP_TIMEOUT = httpx.Timeout(15.0)
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=30, keepalive_expiry=60)
+HTTP_RETRIES = 2
+LOGIN_CONCURRENCY = 8
+# 429 handling: at most RATE_LIMIT_RETRIES sleeps of up to MAX_RETRY_AFTER each, i.e. <= 4 s added per POST.
+# A cold lookup makes three POSTs in a row (grant, MajorLogin, info), so worst case is ~12 s on top of I/O.
+RATE_LIMIT_RETRIES = 2
+MAX_RETRY_AFTER = 2.0
+UID_RE = re.compile(r"[0-9]{5,15}")
+INVALID_UID_ERROR = {"error": "Invalid UID. It must be 5-15 digits."}
+GRANT_URL = "https://ffmconnect.live.gop.garenanow.com/oauth/guest/token/grant"
+LOGIN_URL = "https://loginbp.ggblueshark.com/MajorLogin"
+GRANT_PARAMS = "&response_type=token&client_type=2&client_secret=2ee44819e9b4598845141067b281621874d0d5d7af9d8f7e00c1e54715b7d1e3&client_id=100067"
+GRANT_HEADERS = {'User-Agent': USERAGENT, 'Connection': "Keep-Alive", 'Accept-Encoding': "gzip", 'Content-Type': "application/x-www-form-urlencoded"}
+GAME_HEADERS = {'User-Agent': USERAGENT, 'Connection': "Keep-Alive", 'Accept-Encoding': "gzip",
+                'Content-Type': "application/octet-stream", 'Expect': "100-continue", 'X-Unity-Version': "2018.4.11f1",
+                'X-GA': "v1 1", 'ReleaseVersion': RELEASEVERSION}
+
+IND_ACCOUNT = "uid=3933356115&password=CA6DDAEE7F32A95D6BC17B15B8D5C59E091338B4609F25A1728720E8E4C107C4"
+AMERICAS_BD_ACCOUNT = "uid=4391988328&password=D9A6027CF6CD8E0B1CB5DC0D36E8C51A853E753E970463CB5452EBE423C0D79A"
+DEFAULT_ACCOUNT = "uid=4108414251&password=E4F9C33BBEB23C0DA0AD7E60F63C8A05D6A878798E3CD32C4E2314C1EEFD4F72"
+REGION_ACCOUNTS = {"IND": IND_ACCOUNT, "BD": AMERICAS_BD_ACCOUNT, "US": AMERICAS_BD_ACCOUNT,
+                   "SAC": AMERICAS_BD_ACCOUNT, "NA": AMERICAS_BD_ACCOUNT}
 
 # === Flask App Setup ===
 
+logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
-cache = TTLCache(maxsize=100, ttl=300)
 cached_tokens = defaultdict(dict)
-uid_region_cache = {}
+# One login at a time per region across all request threads; the per-lookup semaphore only bounds a single lookup.
+region_login_locks = {r: threading.Lock() for r in SUPPORTED_REGIONS}
+uid_region_cache = LRUCache(maxsize=10_000)
+# cachetools caches aren't thread-safe and Flask serves requests on worker threads.
+uid_region_lock = threading.Lock()
+
+# === Errors ===
+
+class TokenError(Exception):
+    """Raised when a region login doesn't yield a usable token."""
+
+class RegionMiss(Exception):
+    """Raised when a region answers but has no profile for the requested UID."""
 
 # === Helper Functions ===
 
@@ -45,90 +83,198 @@ def decode_protobuf(encoded_data: bytes, message_type: message.Message) -> messa
     instance.ParseFromString(encoded_data)
     return instance
 
-async def json_to_proto(json_data: str, proto_message: Message) -> bytes:
-    json_format.ParseDict(json.loads(json_data), proto_message)
+def dict_to_proto(data: dict, proto_message: Message) -> bytes:
+    json_format.ParseDict(data, proto_message)
     return proto_message.SerializeToString()
 
+def new_http_client() -> httpx.AsyncClient:
+    transport = httpx.AsyncHTTPTransport(limits=HTTP_LIMITS, retries=HTTP_RETRIES)
+    return httpx.AsyncClient(timeout=HTTP_TIMEOUT, transport=transport)
+
+async def post_with_retry(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    # Back off on 429 instead of failing the lookup, honouring Retry-After when the server sends one.
+    # If the server asks for a longer wait than we can afford, give up rather than retry early into another 429.
+    # A 429 that survives the retries is raised so callers never parse the error body as a real reply.
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        resp = await client.post(url, **kwargs)
+        if resp.status_code != 429:
+            return resp
+        retry_after = resp.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else 0.5 * 2 ** attempt
+        if attempt == RATE_LIMIT_RETRIES or delay > MAX_RETRY_AFTER:
+            resp.raise_for_status()
+        await asyncio.sleep(delay)
+
 def get_account_credentials(region: str) -> str:
-    r = region.upper()
-    if r == "IND":
-        return "uid=3933356115&password=CA6DDAEE7F32A95D6BC17B15B8D5C59E091338B4609F25A1728720E8E4C107C4"
-    elif r in {"BD", "US", "SAC", "NA"}:
-        return "uid=4391988328&password=D9A6027CF6CD8E0B1CB5DC0D36E8C51A853E753E970463CB5452EBE423C0D79A"
-    else:
-        return "uid=4108414251&password=E4F9C33BBEB23C0DA0AD7E60F63C8A05D6A878798E3CD32C4E2314C1EEFD4F72"
+    return REGION_ACCOUNTS.get(region.upper(), DEFAULT_ACCOUNT)
 
 # === Token Generation ===
 
-async def get_access_token(account: str):
-    url = "https://ffmconnect.live.gop.garenanow.com/oauth/guest/token/grant"
-    payload = account + "&response_type=token&client_type=2&client_secret=2ee44819e9b4598845141067b281621874d0d5d7af9d8f7e00c1e54715b7d1e3&client_id=100067"
-    headers = {'User-Agent': USERAGENT, 'Connection': "Keep-Alive", 'Accept-Encoding': "gzip", 'Content-Type': "application/x-www-form-urlencoded"}
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, data=payload, headers=headers)
-        data = resp.json()
-        return data.get("access_token", "0"), data.get("open_id", "0")
+async def get_access_token(client: httpx.AsyncClient, account: str):
+    payload = account + GRANT_PARAMS
+    resp = await post_with_retry(client, GRANT_URL, data=payload, headers=GRANT_HEADERS)
+    data = orjson.loads(resp.content)
+    return data.get("access_token", "0"), data.get("open_id", "0")
 
-async def create_jwt(region: str):
+async def create_jwt(client: httpx.AsyncClient, region: str):
     account = get_account_credentials(region)
-    token_val, open_id = await get_access_token(account)
-    body = json.dumps({"open_id": open_id, "open_id_type": "4", "login_token": token_val, "orign_platform_type": "4"})
-    proto_bytes = await json_to_proto(body, FreeFire_pb2.LoginReq())
+    token_val, open_id = await get_access_token(client, account)
+    body = {"open_id": open_id, "open_id_type": "4", "login_token": token_val, "orign_platform_type": "4"}
+    proto_bytes = dict_to_proto(body, FreeFire_pb2.LoginReq())
     payload = aes_cbc_encrypt(MAIN_KEY, MAIN_IV, proto_bytes)
-    url = "https://loginbp.ggblueshark.com/MajorLogin"
-    headers = {'User-Agent': USERAGENT, 'Connection': "Keep-Alive", 'Accept-Encoding': "gzip",
-               'Content-Type': "application/octet-stream", 'Expect': "100-continue", 'X-Unity-Version': "2018.4.11f1",
-               'X-GA': "v1 1", 'ReleaseVersion': RELEASEVERSION}
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(url, data=payload, headers=headers)
-        msg = json.loads(json_format.MessageToJson(decode_protobuf(resp.content, FreeFire_pb2.LoginRes)))
-        cached_tokens[region] = {
-            'token': f"Bearer {msg.get('token','0')}",
-            'region': msg.get('lockRegion','0'),
-            'server_url': msg.get('serverUrl','0'),
-            'expires_at': time.time() + 25200
-        }
-
-async def initialize_tokens():
-    tasks = [create_jwt(r) for r in SUPPORTED_REGIONS]
-    await asyncio.gather(*tasks)
+    resp = await post_with_retry(client, LOGIN_URL, data=payload, headers=GAME_HEADERS)
+    msg = json_format.MessageToDict(decode_protobuf(resp.content, FreeFire_pb2.LoginRes))
+    if not msg.get('token') or not msg.get('serverUrl'):
+        # Caching this would pin a dead 'Bearer 0' token for the whole token lifetime.
+        raise TokenError(f"MajorLogin for {region} returned no token (HTTP {resp.status_code})")
+    cached_tokens[region] = {
+        'token': f"Bearer {msg.get('token','0')}",
+        'region': msg.get('lockRegion','0'),
+        'server_url': msg.get('serverUrl','0'),
+        'expires_at': time.time() + 25200
+    }
+
+async def initialize_tokens(client: httpx.AsyncClient):
+    sem = asyncio.Semaphore(LOGIN_CONCURRENCY)
+
+    async def refresh_region(region):
+        async with sem:
+            await create_jwt(client, region)
+
+    results = await asyncio.gather(*(refresh_region(r) for r in SUPPORTED_REGIONS), return_exceptions=True)
+    # Let every region finish before reporting a failure, so one bad login doesn't leave the rest half-done.
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+
+async def refresh_all_tokens():
+    async with new_http_client() as client:
+        await initialize_tokens(client)
 
 async def refresh_tokens_periodically():
-    while True:
-        await asyncio.sleep(25200)
-        await initialize_tokens()
+    async with new_http_client() as client:
+        while True:
+            await asyncio.sleep(25200)
+            await initialize_tokens(client)
 
-async def get_token_info(region: str) -> Tuple[str,str,str]:
+def fresh_token_info(region: str):
     info = cached_tokens.get(region)
     if info and time.time() < info['expires_at']:
-        return info['token'], info['region'], info['server_url']
-    await create_jwt(region)
-    info = cached_tokens[region]
+        return info
+    return None
+
+async def get_token_info(client: httpx.AsyncClient, region: str, login_sem=None) -> Tuple[str,str,str]:
+    info = fresh_token_info(region)
+    if info is None:
+        # If another request is already logging in to this region, wait for its token instead of
+        # starting a second login. Poll rather than block so this thread's other probes keep running.
+        lock = region_login_locks[region]
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        try:
+            info = fresh_token_info(region)
+            if info is None:
+                if login_sem is None:
+                    await create_jwt(client, region)
+                else:
+                    async with login_sem:
+                        await create_jwt(client, region)
+                info = cached_tokens[region]
+        finally:
+            lock.release()
     return info['token'], info['region'], info['server_url']
 
-async def GetAccountInformation(uid, unk, region, endpoint):
-    payload = await json_to_proto(json.dumps({'a': uid, 'b': unk}), main_pb2.GetPlayerPersonalShow())
+async def GetAccountInformation(client, uid, unk, region, endpoint, login_sem=None):
+    payload = dict_to_proto({'a': uid, 'b': unk}, main_pb2.GetPlayerPersonalShow())
     data_enc = aes_cbc_encrypt(MAIN_KEY, MAIN_IV, payload)
-    token, lock, server = await get_token_info(region)
-    headers = {'User-Agent': USERAGENT, 'Connection': "Keep-Alive", 'Accept-Encoding': "gzip",
-               'Content-Type': "application/octet-stream", 'Expect': "100-continue",
-               'Authorization': token, 'X-Unity-Version': "2018.4.11f1", 'X-GA': "v1 1",
-               'ReleaseVersion': RELEASEVERSION}
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(server+endpoint, data=data_enc, headers=headers)
-        return json.loads(json_format.MessageToJson(decode_protobuf(resp.content, AccountPersonalShow_pb2.AccountPersonalShowInfo)))
+    token, lock, server = await get_token_info(client, region, login_sem)
+    headers = {**GAME_HEADERS, 'Authorization': token}
+    resp = await post_with_retry(client, server+endpoint, data=data_enc, headers=headers)
+    resp.raise_for_status()  # error replies can decode to an empty profile; they must not win the region race
+    profile = json_format.MessageToDict(decode_protobuf(resp.content, AccountPersonalShow_pb2.AccountPersonalShowInfo))
+    if 'basicInfo' not in profile:
+        raise RegionMiss(f"No profile for UID {uid} in {region}")
+    return profile
+
+def is_region_miss(exc: Exception) -> bool:
+    # Only a region that answered without a profile proves the UID lives elsewhere. Network errors,
+    # 401/403/429/5xx replies, undecodable error bodies and failed token logins say nothing about it.
+    return isinstance(exc, RegionMiss)
+
+async def probe_region(client, uid, region, login_sem):
+    return region, await GetAccountInformation(client, uid, "7", region, "/GetPlayerPersonalShow", login_sem)
+
+async def fetch_account_info(uid):
+    # One client per lookup so the token grant, login and info calls share pooled connections.
+    async with new_http_client() as client:
+        regions = SUPPORTED_REGIONS
+        # Check cached region for UID
+        with uid_region_lock:
+            cached_region = uid_region_cache.get(uid)
+        if cached_region is not None:
+            try:
+                return await GetAccountInformation(client, uid, "7", cached_region, "/GetPlayerPersonalShow")
+            except Exception as e:
+                logger.warning("Cached region %s failed for UID %s: %s", cached_region, uid, e)
+                # Only a definitive miss proves the entry is stale; on any other error keep it and re-probe it.
+                if is_region_miss(e):
+                    with uid_region_lock:
+                        uid_region_cache.pop(uid, None)
+                    regions = SUPPORTED_REGIONS - {cached_region}
+
+        # Probe every region at once and keep the first one that returns a profile. Tokens are created
+        # lazily here on a cold start, so cap this lookup's concurrent logins the same way initialize_tokens
+        # does; region_login_locks keeps concurrent requests from logging in to the same region twice.
+        login_sem = asyncio.Semaphore(LOGIN_CONCURRENCY)
+        tasks = [asyncio.ensure_future(probe_region(client, uid, r, login_sem)) for r in regions]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                try:
+                    region, return_data = await fut
+                except Exception as e:
+                    logger.debug("Region probe failed for UID %s: %s", uid, e)
+                    continue
+                with uid_region_lock:
+                    uid_region_cache[uid] = region
+                return return_data
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return None
+
+# === Validation Decorator ===
+
+def require_valid_uid(fn):
+    # Runs before the cache so malformed UIDs never reach the cache or the handler.
+    @wraps(fn)
+    def wrapper(*a, **k):
+        uid = request.args.get('uid')
+        if not uid:
+            return jsonify({"error": "Please provide UID."}), 400
+        if not UID_RE.fullmatch(uid):
+            return jsonify(INVALID_UID_ERROR), 400
+        return fn(*a, **k)
+    return wrapper
 
 # === Caching Decorator ===
 
-def cached_endpoint(ttl=300):
+def cached_endpoint(ttl=300, maxsize=1024):
     def decorator(fn):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        lock = threading.Lock()
         @wraps(fn)
         def wrapper(*a, **k):
-            key = (request.path, tuple(request.args.items()))
-            if key in cache:
-                return cache[key]
+            key = (request.path, tuple(sorted(request.args.items())))
+            with lock:
+                cached = cache.get(key)
+            if cached is not None:
+                return cached
             res = fn(*a, **k)
-            cache[key] = res
+            # Only successful lookups are cached; errors must not stick around for `ttl` seconds.
+            if isinstance(res, tuple) and res[1] == 200:
+                with lock:
+                    cache[key] = res
             return res
         return wrapper
     return decorator
@@ -136,46 +282,32 @@ def cached_endpoint(ttl=300):
 # === Flask Routes ===
 
 @app.route('/player-info')
+@require_valid_uid
 @cached_endpoint()
 def get_account_info():
-    uid = request.args.get('uid')
-    if not uid:
-        return jsonify({"error": "Please provide UID."}), 400
-
-    # Check cached region for UID
-    if uid in uid_region_cache:
-        try:
-            return_data = asyncio.run(GetAccountInformation(uid, "7", uid_region_cache[uid], "/GetPlayerPersonalShow"))
-            formatted_json = json.dumps(return_data, indent=2, ensure_ascii=False)
-            return formatted_json, 200, {'Content-Type': 'application/json; charset=utf-8'}
-        except:
-            pass  # fallback to testing all regions
-
-    for region in SUPPORTED_REGIONS:
-        try:
-            return_data = asyncio.run(GetAccountInformation(uid, "7", region, "/GetPlayerPersonalShow"))
-            uid_region_cache[uid] = region
-            formatted_json = json.dumps(return_data, indent=2, ensure_ascii=False)
-            return formatted_json, 200, {'Content-Type': 'application/json; charset=utf-8'}
-        except:
-            continue
+    uid = request.args['uid']
+    return_data = asyncio.run(fetch_account_info(uid))
+    if return_data is not None:
+        formatted_json = orjson.dumps(return_data, option=orjson.OPT_INDENT_2)
+        return formatted_json, 200, {'Content-Type': 'application/json; charset=utf-8'}
 
     return jsonify({"error": "UID not found in any region."}), 404
 
 @app.route('/refresh', methods=['GET','POST'])
 def refresh_tokens_endpoint():
     try:
-        asyncio.run(initialize_tokens())
+        asyncio.run(refresh_all_tokens())
         return jsonify({'message':'Tokens refreshed for all regions.'}),200
     except Exception as e:
+        logger.exception("Token refresh failed")
         return jsonify({'error': f'Refresh failed: {e}'}),500
 
 # === Startup ===
 
 async def startup():
-    await initialize_tokens()
+    await refresh_all_tokens()
     asyncio.create_task(refresh_tokens_periodically())
 
 if __name__ == '__main__':
     asyncio.run(startup())
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)